@@ -12,6 +12,7 @@ class MediaType(str, Enum):
     GEOJSONSEQ = "application/geo+json-seq"
     GEOPARQUET = "application/x-parquet"
     PARQUET = "application/x-parquet"
+    ARROW = "application/vnd.apache.arrow.stream"
     SCHEMAJSON = "application/schema+json"
     HTML = "text/html"
     TEXT = "text/plain"
@@ -29,6 +30,7 @@ class OutputFormat(str, Enum):
     CSV = "csv"
     GEOPARQUET = "geoparquet"
     PARQUET = "parquet"
+    ARROW = "arrow"
 
 
 FilterLang = Literal["cql2-text", "cql2-json"]
@@ -1,27 +1,41 @@
 import logging
-import re
+import queue
+import threading
 import time
-from collections.abc import Generator
-from contextlib import asynccontextmanager
+from collections.abc import AsyncGenerator, Generator, Iterable
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager, contextmanager
 from datetime import UTC, datetime
 from pathlib import Path
 from typing import Annotated, Any
 from urllib.parse import urlencode
 
+import anyio
 import cql2
 import duckdb
-import orjson
-from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response, status
+import pyarrow as pa
+from anyio.lowlevel import RunVar
+from fastapi import (
+    Depends,
+    FastAPI,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    status,
+)
 from fastapi.responses import HTMLResponse, StreamingResponse
 from jinja2 import Environment, FileSystemLoader
-from starlette.templating import Jinja2Templates
+from starlette.types import Receive, Scope, Send
 
 from app.enums import MediaType, OutputFormat
 from app.models import BBox, CQL2FilterParams, Link
 from app.serializers import (
-    stream_csv,
-    stream_feature_collection,
-    stream_geojsonseq,
+    PARQUET_ROW_GROUP_SIZE,
+    stream_arrow,
+    stream_csv_arrow,
+    stream_feature_collection_arrow,
+    stream_geojsonseq_arrow,
     stream_parquet,
 )
 
@@ -31,19 +45,54 @@ logger = logging.getLogger("uvicorn")
 jinja2_env = Environment(
     loader=FileSystemLoader(f"{Path(__file__).resolve().parent}/templates")
 )
-templates = Jinja2Templates(env=jinja2_env)
+VIEWER_TEMPLATE = jinja2_env.get_template("viewer.html")
+
+FEATURE_BATCH_SIZE = 8192
+CURSOR_POOL_SIZE = 16
+PREFETCH_CHUNKS = 16
+# seconds a producer waits for room in its buffer before giving up on a client
+# that stopped reading
+PREFETCH_PUT_TIMEOUT = 30
+PREFETCH_EXECUTOR = ThreadPoolExecutor(
+    max_workers=CURSOR_POOL_SIZE, thread_name_prefix="prefetch"
+)
+# per event loop, as limiters can't be shared between them
+_prefetch_limiter: RunVar[anyio.CapacityLimiter] = RunVar("prefetch_limiter")
+PARQUET_SCHEMA_CACHE_SIZE = 64
+PARQUET_SCHEMA_TTL = 60
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Set application lifespan variables including:
     * A reusable DuckDB connection
+    * A pool of cursors on that connection
     """
     con = duckdb.connect()
     con.execute("PRAGMA enable_profiling='query_tree';")
     extensions = ["httpfs", "azure", "aws", "s3", "spatial"]
-    con.execute("\n".join(f"INSTALL {ext}; LOAD {ext};" for ext in extensions))
-    con.execute("SET http_keep_alive=false;")
+    # only INSTALL what's missing (e.g. not baked into the image), matching
+    # aliases too since "s3" is provided by httpfs
+    installed = set()
+    for name, aliases in con.execute(
+        "SELECT extension_name, aliases FROM duckdb_extensions() WHERE installed"
+    ).fetchall():
+        installed.update([name, *aliases])
+    con.execute(
+        "\n".join(
+            [
+                *(f"INSTALL {ext};" for ext in extensions if ext not in installed),
+                *(f"LOAD {ext};" for ext in extensions),
+            ]
+        )
+    )
+    # reuse HTTP connections and cache Parquet footers across requests, which
+    # otherwise cost a TLS handshake and a metadata fetch per request. GLOBAL
+    # so the settings apply to the cursors handed out to requests, a plain SET
+    # only applies to this connection
+    con.execute(
+        "SET GLOBAL http_keep_alive=true; SET GLOBAL parquet_metadata_cache=true;"
+    )
 
     # TODO: figure out better pattern for this?
     con.execute("""CREATE OR REPLACE SECRET secret (
@@ -53,6 +102,9 @@ async def lifespan(app: FastAPI):
 );""")
 
     app.state.db = con
+    app.state.cursor_pool = queue.Queue(maxsize=CURSOR_POOL_SIZE)
+    for _ in range(CURSOR_POOL_SIZE):
+        app.state.cursor_pool.put_nowait(con.cursor())
     yield
     app.state.db.close()
 
@@ -72,68 +124,270 @@ async def add_process_time_header(request: Request, call_next):
     return response
 
 
-def feature_generator(
-    con: duckdb.DuckDBPyConnection | duckdb.DuckDBPyRelation,
-    geom_column: str,
-) -> Generator[dict[str, Any]]:
-    """Yield GeoJSON like Features from an Arrow Table.
-
-    Attempts to parse geometry column as JSON. If an error
-    occurs, it is left as string (e.g., WKT for CSV output).
-    """
-    for batch in con.arrow(batch_size=100):  # type: ignore
-        for record in batch.to_pylist():
-            if (geometry := record.pop(geom_column, None)) is not None:
-                try:
-                    geometry = orjson.loads(geometry)
-                except orjson.JSONDecodeError:
-                    pass
-            else:
-                continue
-
-            yield {
-                "type": "Feature",
-                "geometry": geometry,
-                "properties": record,
-            }
-
-
-def base_rel(
+# geometry projection for the table formats
+WKB_GEOM_EXPRESSION = "ST_AsWKB({})"
+# the remaining formats wrap a page query so that DuckDB builds each output
+# row, skipping rows without geometry, and rows never become Python objects;
+# `properties` is built from the page schema by `properties_sql`
+FEATURE_JSON_SQL = """SELECT json_object(
+    'type', 'Feature',
+    'geometry', ST_AsGeoJSON({geom_column})::JSON,
+    'properties', {properties}
+) AS feature
+FROM ({sql})
+WHERE {geom_column} IS NOT NULL"""
+FEATURE_CSV_SQL = """SELECT
+    'Feature' AS type,
+    ST_AsText({geom_column}) AS geometry,
+    ({properties})::VARCHAR AS properties
+FROM ({sql})
+WHERE {geom_column} IS NOT NULL"""
+FEATURE_QUERIES = {
+    OutputFormat.GEOJSON: FEATURE_JSON_SQL,
+    OutputFormat.GEOJSONSEQ: FEATURE_JSON_SQL,
+    OutputFormat.NDJSON: FEATURE_JSON_SQL,
+    OutputFormat.CSV: FEATURE_CSV_SQL,
+}
+# streamers for the feature formats other than FeatureCollection
+FEATURE_STREAMERS = {
+    OutputFormat.GEOJSONSEQ: stream_geojsonseq_arrow,
+    OutputFormat.NDJSON: stream_geojsonseq_arrow,
+    OutputFormat.CSV: stream_csv_arrow,
+}
+# streamers writing the query's record batches as a table with GeoParquet
+# metadata, which is produced even for an empty page
+TABLE_STREAMERS = {
+    OutputFormat.GEOPARQUET: stream_parquet,
+    OutputFormat.PARQUET: stream_parquet,
+    OutputFormat.ARROW: stream_arrow,
+}
+
+
+def build_select_sql(
     *,
-    con: duckdb.DuckDBPyConnection,
     url: str,
     bbox: BBox | None,
     filter: cql2.Expr | None,
-) -> duckdb.DuckDBPyRelation:
+    columns: str = "*",
+    limit: int | None = None,
+    offset: int = 0,
+) -> tuple[str, list[Any]]:
+    """Build a single SELECT statement over `url` and its positional parameters.
+
+    Keeping the projection, filters and LIMIT/OFFSET in one statement lets
+    DuckDB plan them together and stop reading Parquet once the page is full.
+
+    Run the result with `con.execute(sql, params)`: `con.sql` with parameters
+    executes eagerly and materializes the whole result as a relation, while
+    `execute` leaves it to be streamed (e.g. via `fetch_record_batch`).
+    """
     filters = list()
+    params: list[Any] = list()
 
     if bbox is not None:
         filters.append(bbox.to_sql())
 
-    cql_filter = None
-    cql_params = None
     if filter:
         cql_filter = filter.to_sql()
         filters.append(cql_filter.query)
-        cql_params = cql_filter.params
-
-    filter_stmt = f"WHERE {' AND '.join(filters)}"
+        params.extend(cql_filter.params)
 
     # HACK: rewrite scheme for Azure URLs (https:// -> az://)
     if url.startswith("https") and "blob.core.windows.net" in url:
-        url = re.sub("^https", "az", url)
+        url = "az" + url.removeprefix("https")
+
+    # bind the url after any CQL2 parameters ($1..$n) rather than inlining it
+    params.append(url)
+
+    sql = f"SELECT {columns}\nFROM read_parquet(${len(params)})"
+    if filters:
+        sql += f"\nWHERE {' AND '.join(filters)}"
+    if limit is not None:
+        params.extend([limit, offset])
+        sql += f"\nLIMIT ${len(params) - 1} OFFSET ${len(params)}"
+
+    return sql, params
+
+
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def quote_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def json_value_sql(expr: str, data_type: pa.DataType, depth: int = 0) -> str:
+    """Rewrite `expr` so that DuckDB's JSON for it matches orjson's.
+
+    Non-finite floats become null rather than bare `NaN`/`Infinity` and
+    timestamps use ISO 8601, also inside structs, lists, maps and unions.
+    Maps are rendered as JSON objects and unions as their current member.
+    """
+    if pa.types.is_floating(data_type):
+        return f"CASE WHEN isfinite({expr}) THEN {expr} END"
+    if pa.types.is_timestamp(data_type):
+        suffix = ""
+        if data_type.tz is None:
+            expr = f"{expr}::TIMESTAMP"
+        else:
+            # rendered in the session time zone, like the Arrow values were;
+            # %z gives whole hour offsets without minutes, e.g. +01
+            offset = f"strftime({expr}, '%z')"
+            suffix = (
+                f" || CASE WHEN length({offset}) = 3"
+                f" THEN {offset} || ':00' ELSE {offset} END"
+            )
+        # like datetime.isoformat(), only show microseconds when there are any
+        return (
+            f"CASE WHEN microsecond({expr}) % 1000000 = 0"
+            f" THEN strftime({expr}, '%Y-%m-%dT%H:%M:%S')"
+            f" ELSE strftime({expr}, '%Y-%m-%dT%H:%M:%S.%f') END{suffix}"
+        )
+    if pa.types.is_struct(data_type):
+        # by position and with json_object, since a field may be named "" (as
+        # DuckDB names a union's tag when writing it to Parquet), which makes
+        # the struct unnamed to struct_extract and can't be passed to
+        # struct_pack
+        fields = ", ".join(
+            f"{quote_literal(field.name)}, "
+            + json_value_sql(f"struct_extract_at({expr}, {i})", field.type, depth)
+            for i, field in enumerate(data_type, start=1)
+        )
+        return f"CASE WHEN {expr} IS NOT NULL THEN json_object({fields}) END"
+    if (
+        pa.types.is_list(data_type)
+        or pa.types.is_large_list(data_type)
+        or pa.types.is_fixed_size_list(data_type)
+    ):
+        element = f"x{depth}"
+        value = json_value_sql(element, data_type.value_type, depth + 1)
+        return f"list_transform({expr}, lambda {element}: {value})"
+    if pa.types.is_map(data_type):
+        entry = f"x{depth}"
+        key = f"struct_extract({entry}, 'key')"
+        # float keys are rendered as strings, so only the values need nulls
+        if not pa.types.is_floating(data_type.key_type):
+            key = json_value_sql(key, data_type.key_type, depth + 1)
+        value = json_value_sql(
+            f"struct_extract({entry}, 'value')", data_type.item_type, depth + 1
+        )
+        return (
+            f"map_from_entries(list_transform(map_entries({expr}),"
+            f" lambda {entry}: {{'key': {key}, 'value': {value}}}))"
+        )
+    if pa.types.is_union(data_type):
+        # the members differ in type, so each is converted to JSON on its own
+        members = " ".join(
+            f"WHEN {quote_literal(field.name)} THEN to_json("
+            + json_value_sql(
+                f"union_extract({expr}, {quote_literal(field.name)})",
+                field.type,
+                depth,
+            )
+            + ")"
+            for field in data_type
+        )
+        return f"CASE union_tag({expr}) {members} END"
+    return expr
+
+
+def properties_sql(schema: pa.Schema, geom_column: str) -> str:
+    """JSON expression for a feature's properties: every non-geometry column."""
+    columns = [field for field in schema if field.name != geom_column]
+    if not columns:
+        return "'{}'::JSON"
+    fields = ", ".join(
+        f"{quote_identifier(field.name)} := "
+        + json_value_sql(quote_identifier(field.name), field.type)
+        for field in columns
+    )
+    return f"to_json(struct_pack({fields}))"
+
+
+# page schemas by url with the time they expire, least recently used first
+PARQUET_SCHEMAS: dict[str, tuple[float, pa.Schema]] = {}
+PARQUET_SCHEMAS_LOCK = threading.Lock()
+
+
+def parquet_schema(con: duckdb.DuckDBPyConnection, url: str) -> pa.Schema:
+    """Schema of the columns read from `url`.
+
+    Cached per url for `PARQUET_SCHEMA_TTL` seconds, since it doesn't depend
+    on the filters or the page and reading it again would cost another footer
+    request for remote files. The file may still change under the same url,
+    see `evict_parquet_schema`.
+    """
+    now = time.monotonic()
+    with PARQUET_SCHEMAS_LOCK:
+        if (entry := PARQUET_SCHEMAS.pop(url, None)) is not None and entry[0] > now:
+            PARQUET_SCHEMAS[url] = entry
+            return entry[1]
 
-    rel = con.sql(
-        f"""SELECT *
-FROM read_parquet('{url}')
-{filter_stmt if filters else ""}""",
-        params=cql_params if filter else None,
+    # LIMIT 0 only binds the query, which is enough for its schema
+    sql, params = build_select_sql(url=url, bbox=None, filter=None, limit=0)
+    schema = con.execute(sql, params).fetch_record_batch().schema
+
+    with PARQUET_SCHEMAS_LOCK:
+        PARQUET_SCHEMAS.pop(url, None)
+        while len(PARQUET_SCHEMAS) >= PARQUET_SCHEMA_CACHE_SIZE:
+            del PARQUET_SCHEMAS[next(iter(PARQUET_SCHEMAS))]
+        PARQUET_SCHEMAS[url] = (now + PARQUET_SCHEMA_TTL, schema)
+    return schema
+
+
+def evict_parquet_schema(url: str) -> None:
+    with PARQUET_SCHEMAS_LOCK:
+        PARQUET_SCHEMAS.pop(url, None)
+
+
+def build_feature_sql(query: str, schema: pa.Schema, sql: str, geom_column: str) -> str:
+    """Wrap the page query `sql`, whose columns are `schema`, in one of the
+    feature query templates.
+    """
+    return query.format(
+        geom_column=geom_column,
+        properties=properties_sql(schema, geom_column),
+        sql=sql,
     )
-    return rel
 
 
-def get_count(rel: duckdb.DuckDBPyRelation) -> int:
-    return (rel.count("*").fetchone() or [0])[0]
+def execute_feature_query(
+    con: duckdb.DuckDBPyConnection,
+    query: str,
+    url: str,
+    sql: str,
+    params: list[Any],
+    geom_column: str,
+) -> duckdb.DuckDBPyConnection:
+    """Execute the page query `sql` wrapped in one of the feature query
+    templates, reading the page schema from the cache.
+
+    A binder error may mean that columns were removed from the file since its
+    schema was cached, so the query is retried once with a fresh schema.
+    """
+    try:
+        return con.execute(
+            build_feature_sql(query, parquet_schema(con, url), sql, geom_column),
+            params,
+        )
+    except duckdb.BinderException:
+        evict_parquet_schema(url)
+        return con.execute(
+            build_feature_sql(query, parquet_schema(con, url), sql, geom_column),
+            params,
+        )
+
+
+def get_count(
+    *,
+    con: duckdb.DuckDBPyConnection,
+    url: str,
+    bbox: BBox | None,
+    filter: cql2.Expr | None,
+) -> int:
+    sql, params = build_select_sql(url=url, bbox=bbox, filter=filter)
+    return (con.execute(f"SELECT count(*) FROM ({sql})", params).fetchone() or [0])[0]
 
 
 def build_links(
@@ -142,7 +396,6 @@ def build_links(
     limit: int,
     offset: int,
 ) -> list[Link]:
-    params: dict[str, Any] = request.query_params._dict.copy()
     links = [
         Link(
             title="Features",
@@ -152,26 +405,28 @@ def build_links(
         )
     ]
 
-    base_url = request.url_for("get_features")._url
+    # encode the query once, only the offset differs between pages
+    query = urlencode(
+        [(k, v) for k, v in request.query_params.items() if k != "offset"]
+    )
+    page_url = f"{request.url_for('get_features')._url}?{query}{'&' if query else ''}"
 
     if (next_offset := (offset + limit)) < number_matched:
-        params["offset"] = next_offset
         links.append(
             Link(
                 title="Next page",
                 rel="next",
-                href=f"{base_url}?{urlencode(params)}",
+                href=f"{page_url}offset={next_offset}",
                 type=MediaType.GEOJSON,
             )
         )
 
     if offset > 0:
-        params["offset"] = max(offset - limit, 0)
         links.append(
             Link(
                 title="Previous page",
                 rel="prev",
-                href=f"{base_url}?{urlencode(params)}",
+                href=f"{page_url}offset={max(offset - limit, 0)}",
                 type=MediaType.GEOJSON,
             )
         )
@@ -192,58 +447,211 @@ def stream_features(
     bbox: BBox | None = None,
 ) -> Generator[bytes]:
     """Stream features from GeoParquet."""
-    rel = base_rel(
-        con=con,
-        url=url,
-        bbox=bbox,
-        filter=filter,
-    )
-    total = get_count(rel)
+    total = get_count(con=con, url=url, bbox=bbox, filter=filter)
 
     offset = min(offset, max(total - limit, 0))
+    # the page size follows from the total, no need to scan again
+    num_returned = min(limit, max(total - offset, 0))
+
+    if (query := FEATURE_QUERIES.get(output_format)) is not None:
+        batches: Iterable[pa.RecordBatch] = ()
+        # nothing on this page (e.g. limit=0), skip the feature query
+        if num_returned > 0:
+            sql, params = build_select_sql(
+                url=url, bbox=bbox, filter=filter, limit=limit, offset=offset
+            )
+            batches = execute_feature_query(
+                con, query, url, sql, params, geom_column
+            ).fetch_record_batch(min(limit, FEATURE_BATCH_SIZE))
 
-    geom_conversion_func = "ST_AsGeoJSON"
-    match output_format:
-        case OutputFormat.CSV:
-            geom_conversion_func = "ST_AsText"
-        case OutputFormat.GEOPARQUET | OutputFormat.PARQUET:
-            geom_conversion_func = "ST_AsWKB"
-
-    filtered = rel.project(
-        f"{geom_conversion_func}({geom_column}) {geom_column}, "
-        f"* EXCLUDE ({geom_column})"
-    ).limit(limit, offset=offset)
-
-    if output_format in [OutputFormat.GEOPARQUET, OutputFormat.PARQUET]:
-        yield from stream_parquet(
-            rel=filtered,
-            geom_column=geom_column,
-            bbox_column=bbox_column,
-        )
-    else:
-        features = feature_generator(filtered, geom_column)
-        if output_format == OutputFormat.GEOJSON or output_format is None:
-            num_returned = get_count(filtered)
+        if output_format == OutputFormat.GEOJSON:
             links = build_links(
                 request, number_matched=total, limit=limit, offset=offset
             )
-            yield from stream_feature_collection(
-                features=features,
+            yield from stream_feature_collection_arrow(
+                batches=batches,
                 number_matched=total,
                 number_returned=num_returned,
                 limit=limit,
                 offset=offset,
                 links=links,
             )
-        elif output_format in [OutputFormat.GEOJSONSEQ, OutputFormat.NDJSON]:
-            yield from stream_geojsonseq(features)
-        elif output_format == OutputFormat.CSV:
-            yield from stream_csv(features)
+        else:
+            yield from FEATURE_STREAMERS[output_format](batches)
+        return
+
+    sql, params = build_select_sql(
+        url=url,
+        bbox=bbox,
+        filter=filter,
+        columns=(
+            f"{WKB_GEOM_EXPRESSION.format(geom_column)} AS {geom_column}, "
+            f"* EXCLUDE ({geom_column})"
+        ),
+        # an empty page still needs the schema, which LIMIT 0 gets without
+        # scanning
+        limit=limit if num_returned else 0,
+        offset=offset,
+    )
+    # DuckDB hands the batches over through the Arrow C stream interface,
+    # pulled on demand as the writer consumes them, one Parquet row group each
+    yield from TABLE_STREAMERS[output_format](
+        reader=con.execute(sql, params).fetch_record_batch(PARQUET_ROW_GROUP_SIZE),
+        geom_column=geom_column,
+        bbox_column=bbox_column,
+    )
+
 
+class _ProducerDone:
+    """Marks the end of a prefetched stream, carrying any error raised."""
 
-def duckdb_cursor(request: Request) -> duckdb.DuckDBPyConnection:
-    """Returns a threadsafe cursor from the connection stored in app state."""
-    return request.app.state.db.cursor()
+    def __init__(self, error: Exception | None = None):
+        self.error = error
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """StreamingResponse that closes its body iterator however the response
+    ends.
+
+    Starlette leaves the iterator suspended when sending fails, e.g. on a
+    client disconnect, so its cleanup would wait for garbage collection.
+    """
+
+    body_iterator: AsyncGenerator[bytes]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await self.body_iterator.aclose()
+
+
+def drain(buffer: queue.Queue) -> None:
+    try:
+        while True:
+            buffer.get_nowait()
+    except queue.Empty:
+        pass
+
+
+def prefetch_limiter() -> anyio.CapacityLimiter:
+    """Limits /features streams to one producer per pooled cursor."""
+    try:
+        return _prefetch_limiter.get()
+    except LookupError:
+        limiter = anyio.CapacityLimiter(CURSOR_POOL_SIZE)
+        _prefetch_limiter.set(limiter)
+        return limiter
+
+
+async def prefetch_in_thread(
+    chunks: Generator[bytes], max_buffered: int = PREFETCH_CHUNKS
+) -> AsyncGenerator[bytes]:
+    """Run a chunk generator on a `PREFETCH_EXECUTOR` thread, buffering up to
+    `max_buffered`.
+
+    Starlette only advances a sync generator when the previous chunk has been
+    sent, so DuckDB sits idle while the socket is written. Producing on a
+    separate thread lets the next batches be fetched and serialized meanwhile.
+    """
+    # wait for a producer slot without holding a worker thread: waiting in
+    # buffer.get for a producer that hasn't started would hold one of anyio's
+    # worker threads, which the running streams (and the sync routes) need
+    limiter = prefetch_limiter()
+    # borrowed on behalf of the stream rather than the task, which may be a
+    # different one when the response closes the stream
+    borrower = object()
+    await limiter.acquire_on_behalf_of(borrower)
+
+    buffer: queue.Queue[bytes | _ProducerDone] = queue.Queue(maxsize=max_buffered)
+    stopped = threading.Event()
+
+    def fail(error: Exception) -> None:
+        if not stopped.is_set():
+            # the response fails, so the chunks still buffered won't be sent
+            drain(buffer)
+            buffer.put_nowait(_ProducerDone(error))
+
+    def produce() -> None:
+        try:
+            for chunk in chunks:
+                # bounded so that a client that stopped reading doesn't hold
+                # this thread and the stream's cursor for good
+                buffer.put(chunk, timeout=PREFETCH_PUT_TIMEOUT)
+                if stopped.is_set():
+                    return
+            chunks.close()
+            buffer.put(_ProducerDone(), timeout=PREFETCH_PUT_TIMEOUT)
+        except queue.Full:
+            fail(TimeoutError("The client stopped reading the response"))
+        except Exception as e:
+            fail(e)
+        finally:
+            chunks.close()
+
+    producer = PREFETCH_EXECUTOR.submit(produce)
+
+    try:
+        while not isinstance(
+            item := await anyio.to_thread.run_sync(buffer.get, abandon_on_cancel=True),
+            _ProducerDone,
+        ):
+            yield item
+        if item.error is not None:
+            raise item.error
+    finally:
+        stopped.set()
+        # make room so a producer blocked on a full buffer can notice the stop
+        drain(buffer)
+        # shielded so that a cancelled request still waits for the producer to
+        # close the stream, and with it release anything the stream holds
+        with anyio.CancelScope(shield=True):
+            await anyio.to_thread.run_sync(wait, [producer])
+        limiter.release_on_behalf_of(borrower)
+        # a get abandoned on cancellation is still blocking a worker thread,
+        # and nothing else will be put once the producer is done
+        drain(buffer)
+        buffer.put_nowait(_ProducerDone())
+
+
+def release_cursor(
+    pool: queue.Queue[duckdb.DuckDBPyConnection],
+    cursor: duckdb.DuckDBPyConnection,
+) -> None:
+    try:
+        pool.put_nowait(cursor)
+    except queue.Full:
+        cursor.close()
+
+
+@contextmanager
+def pooled_cursor(app: FastAPI) -> Generator[duckdb.DuckDBPyConnection]:
+    """Takes a cursor from the pool in app state and hands it back on exit.
+
+    A fresh cursor is created if the pool is exhausted.
+    """
+    pool = app.state.cursor_pool
+    try:
+        cursor = pool.get_nowait()
+    except queue.Empty:
+        cursor = app.state.db.cursor()
+
+    try:
+        yield cursor
+    finally:
+        release_cursor(pool, cursor)
+
+
+def duckdb_cursor(request: Request) -> Generator[duckdb.DuckDBPyConnection]:
+    """Yields a threadsafe cursor from the pool stored in app state.
+
+    The cursor goes back to the pool however the request ends, including
+    errors before a response is sent. This runs as soon as the route returns,
+    so streaming routes take their cursor with pooled_cursor instead.
+    """
+    with pooled_cursor(request.app) as cursor:
+        yield cursor
 
 
 def parse_bbox(bbox: str | None = None) -> BBox | None:
@@ -283,13 +691,13 @@ def get_response_headers(output_format: OutputFormat) -> dict[str, str]:
                 MediaType.GEOJSONSEQ: {},
                 MediaType.CSV: {},
                 MediaType.PARQUET: {},
+                MediaType.ARROW: {},
             }
         }
     },
 )
 def get_features(
     request: Request,
-    con: duckdb.DuckDBPyConnection = Depends(duckdb_cursor),
     url: str = Query(),
     limit: int = Query(
         default=10,
@@ -304,19 +712,26 @@ def get_features(
     f: OutputFormat = OutputFormat.GEOJSON,
 ):
     """Get Features"""
-    return StreamingResponse(
-        stream_features(
-            con=con,
-            url=url,
-            limit=limit,
-            offset=offset,
-            geom_column=geom_column,
-            bbox_column=bbox_column,
-            bbox=bbox,
-            filter=filter.cql_filter,
-            output_format=f,
-            request=request,
-        ),
+
+    def chunks() -> Generator[bytes]:
+        # the stream holds the cursor, and the producer thread hands it back
+        # when it closes the stream
+        with pooled_cursor(request.app) as con:
+            yield from stream_features(
+                con=con,
+                url=url,
+                limit=limit,
+                offset=offset,
+                geom_column=geom_column,
+                bbox_column=bbox_column,
+                bbox=bbox,
+                filter=filter.cql_filter,
+                output_format=f,
+                request=request,
+            )
+
+    return ClosingStreamingResponse(
+        prefetch_in_thread(chunks()),
         media_type=MediaType[f.name],
         headers=get_response_headers(f),
     )
@@ -329,13 +744,7 @@ def get_feature_count(
     filter_params: CQL2FilterParams = Depends(CQL2FilterParams),
     bbox: Annotated[BBox, str] | None = Depends(parse_bbox),
 ):
-    rel = base_rel(
-        con=con,
-        url=url,
-        bbox=bbox,
-        filter=filter_params.cql_filter,
-    )
-    total = get_count(rel)
+    total = get_count(con=con, url=url, bbox=bbox, filter=filter_params.cql_filter)
     return {"numberMatched": total}
 
 
@@ -359,43 +768,19 @@ def get_tile(
     filter_params: CQL2FilterParams = Depends(CQL2FilterParams),
     con: duckdb.DuckDBPyConnection = Depends(duckdb_cursor),
 ):
-    tile_bbox = next(
-        iter(
-            con.sql(
-                """SELECT ST_Extent(
-    ST_Transform(
-        ST_TileEnvelope($1, $2, $3),
-        'EPSG:3857',
-        'EPSG:4326',
-        always_xy := true
-    )
-)""",
-                params=[z, x, y],
-            ).fetchone()
-            or []
-        ),
-        None,
-    )
-
-    if tile_bbox is None:
+    try:
+        tile_bbox = BBox.from_tile(z, x, y, bbox_column=bbox_column)
+    except ValueError:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
         )
 
-    rel = base_rel(
-        con=con,
-        url=url,
-        bbox=BBox(
-            bbox_column=bbox_column,
-            xmin=tile_bbox["min_x"],
-            ymin=tile_bbox["min_y"],
-            xmax=tile_bbox["max_x"],
-            ymax=tile_bbox["max_y"],
-        ),
-        filter=filter_params.cql_filter,
+    sql, params = build_select_sql(
+        url=url, bbox=tile_bbox, filter=filter_params.cql_filter
     )
 
-    tile_blob = rel.aggregate(f"""ST_AsMVT(
+    tile_blob = con.execute(
+        f"""SELECT ST_AsMVT(
         {{
             "geometry": ST_AsMVTGeom(
                 ST_Transform(
@@ -407,7 +792,10 @@ def get_tile(
                 ST_Extent(ST_TileEnvelope({z}, {x}, {y}))
             )
         }}
-    )""").fetchone()
+    )
+FROM ({sql})""",
+        params,
+    ).fetchone()
 
     tile = tile_blob[0] if tile_blob and tile_blob[0] else b""
 
@@ -452,6 +840,6 @@ def viewer(
     )
 
     return HTMLResponse(
-        templates.get_template("viewer.html").render(tiles_url=tiles_url),
+        VIEWER_TEMPLATE.render(tiles_url=tiles_url),
         media_type=MediaType.HTML,
     )
@@ -1,3 +1,6 @@
+import math
+from dataclasses import dataclass
+from functools import lru_cache
 from typing import Literal, Self
 
 import cql2
@@ -7,7 +10,8 @@ from pydantic import BaseModel, model_validator
 from app.enums import FilterLang, MediaType
 
 
-class BBox(BaseModel):
+@dataclass(slots=True, kw_only=True)
+class BBox:
     bbox_column: str = "bbox"
     xmin: float
     ymin: float
@@ -26,17 +30,53 @@ class BBox(BaseModel):
 
         return cls(xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax)
 
+    @classmethod
+    def from_tile(cls, z: int, x: int, y: int, bbox_column: str = "bbox") -> Self:
+        """WGS84 bounds of an XYZ (Web Mercator) tile."""
+        n = 2**z
+        if z < 0 or not (0 <= x < n and 0 <= y < n):
+            raise ValueError(f"tile {z}/{x}/{y} is out of range")
+
+        def lat(row: int) -> float:
+            return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+        return cls(
+            bbox_column=bbox_column,
+            xmin=x / n * 360 - 180,
+            ymin=lat(y + 1),
+            xmax=(x + 1) / n * 360 - 180,
+            ymax=lat(y),
+        )
+
     def to_sql(self) -> str:
+        # Compare each covering field directly against a constant, in the
+        # bbox struct field order, so DuckDB pushes the predicates into the
+        # Parquet scan and skips row groups using their min/max statistics.
         return " AND ".join(
             [
-                f"{self.bbox_column}.xmax >= {self.xmin}",
                 f"{self.bbox_column}.xmin <= {self.xmax}",
-                f"{self.bbox_column}.ymax >= {self.ymin}",
                 f"{self.bbox_column}.ymin <= {self.ymax}",
+                f"{self.bbox_column}.xmax >= {self.xmin}",
+                f"{self.bbox_column}.ymax >= {self.ymin}",
             ]
         )
 
 
+@lru_cache(maxsize=1024)
+def parse_cql2_filter(filter: str, filter_lang: FilterLang) -> cql2.Expr:
+    """Parse and validate a CQL2 filter.
+
+    Memoized since the same filter is typically sent with every tile request.
+    """
+    cql_filter = (
+        cql2.parse_text(filter)
+        if filter_lang == "cql2-text"
+        else cql2.parse_json(filter)
+    )
+    cql_filter.validate()
+    return cql_filter
+
+
 class CQL2FilterParams(BaseModel):
     filter: str | None = Query(default=None, description="CQL2 Filter")
     filter_lang: FilterLang = Query(
@@ -46,21 +86,17 @@ class CQL2FilterParams(BaseModel):
     @property
     def cql_filter(self) -> cql2.Expr | None:
         if self.filter:
-            cql_filter = (
-                cql2.parse_text(self.filter)
-                if self.filter_lang == "cql2-text"
-                else cql2.parse_json(self.filter)
-            )
-            return cql_filter
+            return parse_cql2_filter(self.filter, self.filter_lang)
 
     @model_validator(mode="after")
     def validate_filter(self) -> Self:
-        if self.cql_filter:
-            self.cql_filter.validate()
+        if self.filter:
+            parse_cql2_filter(self.filter, self.filter_lang)
         return self
 
 
-class Link(BaseModel):
+@dataclass(slots=True, kw_only=True)
+class Link:
     title: str | None = None
     rel: Literal["self", "next", "prev"]
     href: str
@@ -1,127 +1,292 @@
-import csv
 import io
-from collections.abc import Generator
+from collections.abc import Generator, Iterable
+from functools import lru_cache
+from itertools import chain
 from typing import Any
 
-import duckdb
 import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
 import pyarrow.parquet as pq
 from pyproj import CRS
 
 from app.models import Link
 
 WGS84_CRS_JSON = CRS.from_epsg(4326).to_json_dict()
+# GeoParquet metadata encoded once, with the column names substituted per request
+GEO_METADATA_TEMPLATE = orjson.dumps(
+    {
+        "columns": {
+            "__GEOM__": {
+                "encoding": "WKB",
+                "geometry_types": [],
+                "crs": WGS84_CRS_JSON,
+                "edges": "planar",
+                "covering": {
+                    "bbox": {
+                        "xmin": ["__BBOX__", "xmin"],
+                        "ymin": ["__BBOX__", "ymin"],
+                        "xmax": ["__BBOX__", "xmax"],
+                        "ymax": ["__BBOX__", "ymax"],
+                    }
+                },
+            },
+        },
+        "primary_column": "__GEOM__",
+        "version": "1.1.0",
+    }
+)
+PARQUET_ROW_GROUP_SIZE = 131_072
 
 
-def dump_feat(feat: dict[str, Any]) -> bytes:
-    return orjson.dumps(
-        feat,
-        option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+def feature_collection(
+    features: Any,
+    number_matched: int,
+    number_returned: int,
+    limit: int,
+    offset: int,
+    links: list[Link],
+) -> dict[str, Any]:
+    return {
+        "type": "FeatureCollection",
+        "features": features,
+        "numberMatched": number_matched,
+        "numberReturned": number_returned,
+        "limit": limit,
+        "offset": offset,
+        # orjson serializes the Link dataclasses natively
+        "links": links,
+    }
+
+
+def feature_collection_envelope(
+    number_matched: int,
+    number_returned: int,
+    limit: int,
+    offset: int,
+    links: list[Link],
+) -> tuple[bytes, bytes]:
+    """Encode a FeatureCollection around a placeholder features array and
+    split it into the bytes before and after the features.
+
+    NUL can't otherwise appear in orjson output (it is escaped in strings),
+    so splitting on it is unambiguous.
+    """
+    head, tail = orjson.dumps(
+        feature_collection(
+            orjson.Fragment(b"[\x00]"),
+            number_matched,
+            number_returned,
+            limit,
+            offset,
+            links,
+        )
+    ).split(b"\x00")
+    return head, tail
+
+
+def join_json(values: pa.Array, separator: str) -> bytes:
+    """Concatenate an array of JSON strings in a single Arrow kernel call."""
+    joined = pc.binary_join(
+        pa.ListArray.from_arrays(pa.array([0, len(values)], pa.int32()), values),
+        separator,
     )
+    return joined[0].as_buffer().to_pybytes()
 
 
-def stream_feature_collection(
-    features: Generator[dict[str, Any]],
+def stream_feature_collection_arrow(
+    batches: Iterable[pa.RecordBatch],
     number_matched: int,
     number_returned: int,
     limit: int,
     offset: int,
     links: list[Link],
 ) -> Generator[bytes]:
-    yield b'{"type":"FeatureCollection","features":['
-
-    for i, feat in enumerate(features):
-        if i > 0:
-            yield b"," + dump_feat(feat)
-        else:
-            yield dump_feat(feat)
-
-    metadata = (
-        orjson.dumps(
-            {
-                "numberMatched": number_matched,
-                "numberReturned": number_returned,
-                "limit": limit,
-                "offset": offset,
-                "links": [link.model_dump() for link in links],
-            }
+    """Stream a FeatureCollection from record batches whose first column
+    holds each Feature already encoded as JSON (e.g. by DuckDB's json_object),
+    so features are joined in Arrow without becoming Python objects.
+    """
+    # nothing to stream for an empty page
+    if number_returned == 0:
+        yield orjson.dumps(
+            feature_collection(
+                [], number_matched, number_returned, limit, offset, links
+            )
         )
-        .decode()
-        .strip("{")
+        return
+
+    head, tail = feature_collection_envelope(
+        number_matched, number_returned, limit, offset, links
     )
-    yield f"], {metadata}".encode()
+    yield head
+
+    # separators are yielded on their own rather than concatenated onto (and
+    # so copying) each batch's output
+    batches = (batch for batch in batches if batch.num_rows)
+    if (first := next(batches, None)) is not None:
+        yield join_json(first.column(0), ",")
+        for batch in batches:
+            yield b","
+            yield join_json(batch.column(0), ",")
+
+    yield tail
 
 
-def stream_geojsonseq(features: Generator[dict[str, Any]]) -> Generator[bytes]:
-    for feat in features:
-        yield dump_feat(feat) + b"\n"
+def stream_geojsonseq_arrow(batches: Iterable[pa.RecordBatch]) -> Generator[bytes]:
+    """Newline delimited counterpart of stream_feature_collection_arrow."""
+    for batch in batches:
+        if batch.num_rows:
+            yield join_json(batch.column(0), "\n")
+            yield b"\n"
 
 
-def stream_csv(features: Generator[dict[str, Any]]) -> Generator[bytes]:
-    """Cribbed from TiPG:
-    https://github.com/developmentseed/tipg/blob/b9aff728e857b9d40b56f315d91aa8b6ab397f8f/tipg/factory.py#L100
+class ChunkSink(io.RawIOBase):
+    """Write-only file object that hands written bytes back via drain().
+
+    Written chunks are kept in a list rather than copied into a growable
+    buffer: pyarrow writes bytes objects, which the list keeps without a copy,
+    and a buffer reused per producer thread measured no faster while holding
+    on to its largest size.
     """
 
-    class DummyWriter:
-        """Dummy writer that implements write for use with csv.writer."""
+    def __init__(self):
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        self._position += len(b)
+        return len(b)
 
-        def write(self, line: str):
-            """Return line."""
-            return line
+    def tell(self) -> int:
+        return self._position
 
-    row = next(features)
-    columns = row.keys()
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
 
-    writer = csv.DictWriter(DummyWriter(), fieldnames=columns)
 
-    yield writer.writerow(dict(zip(columns, columns)))
+def stream_csv_arrow(batches: Iterable[pa.RecordBatch]) -> Generator[bytes]:
+    """Write record batches with pyarrow's CSV writer, which formats whole
+    columns in C++ rather than row by row. An empty result produces no
+    output.
+    """
+    batches = (batch for batch in batches if batch.num_rows)
+    if (first := next(batches, None)) is None:
+        return
 
-    yield writer.writerow(row)
+    sink = ChunkSink()
+    with pcsv.CSVWriter(sink, first.schema) as writer:
+        for batch in chain([first], batches):
+            writer.write_batch(batch)
+            yield sink.drain()
 
-    for row in features:
-        yield writer.writerow(row)
+    if chunk := sink.drain():
+        yield chunk
 
 
-def stream_parquet(
-    rel: duckdb.DuckDBPyRelation, geom_column: str, bbox_column: str
-) -> io.BytesIO:
-    # DuckDB → Arrow Table
-    reader = rel.arrow()
-
-    # Optionally add GeoParquet metadata
-    column_meta = {
-        "encoding": "WKB",
-        "geometry_types": [],
-        "crs": WGS84_CRS_JSON,
-        "edges": "planar",
-        "covering": {
-            "bbox": {
-                "xmin": [f"{bbox_column}", "xmin"],
-                "ymin": [f"{bbox_column}", "ymin"],
-                "xmax": [f"{bbox_column}", "xmax"],
-                "ymax": [f"{bbox_column}", "ymax"],
-            }
-        },
-    }
-    geo_meta = {
-        "columns": {
-            geom_column: column_meta,
-        },
-        "primary_column": geom_column,
-        "version": "1.1.0",
-    }
+def with_geo_metadata(
+    schema: pa.Schema, geom_column: str, bbox_column: str
+) -> pa.Schema:
+    """Add GeoParquet metadata for a WKB geometry column to `schema`."""
+    geo_meta = GEO_METADATA_TEMPLATE.replace(
+        b'"__GEOM__"', orjson.dumps(geom_column)
+    ).replace(b'"__BBOX__"', orjson.dumps(bbox_column))
 
-    schema = reader.schema.with_metadata(
+    return schema.with_metadata(
         {
-            **(reader.schema.metadata or {}),
-            b"geo": orjson.dumps(geo_meta),
+            **(schema.metadata or {}),
+            b"geo": geo_meta,
         }
     )
 
-    buf = io.BytesIO()
-    with pq.ParquetWriter(buf, schema, compression="zstd") as writer:
+
+def parquet_writer(where: Any, schema: pa.Schema) -> pq.ParquetWriter:
+    return pq.ParquetWriter(
+        where,
+        schema,
+        compression="zstd",
+        compression_level=3,
+        use_dictionary=True,
+        data_page_size=2 << 20,
+        write_batch_size=8192,
+    )
+
+
+@lru_cache(maxsize=64)
+def empty_parquet(schema: pa.Schema, geom_column: str, bbox_column: str) -> bytes:
+    """Footer-only GeoParquet file, built once per schema.
+
+    The column names are part of the key since the bbox column only appears in
+    the (uncompared) schema metadata.
+    """
+    sink = ChunkSink()
+    with parquet_writer(sink, with_geo_metadata(schema, geom_column, bbox_column)):
+        pass
+    return sink.drain()
+
+
+def stream_parquet(
+    reader: pa.RecordBatchReader, geom_column: str, bbox_column: str
+) -> Generator[bytes]:
+    batches = iter(reader)
+    if (first := next(batches, None)) is None:
+        yield empty_parquet(reader.schema, geom_column, bbox_column)
+        return
+
+    schema = with_geo_metadata(reader.schema, geom_column, bbox_column)
+
+    # yield whatever the writer flushed after each row group rather than
+    # buffering the whole file
+    sink = ChunkSink()
+    with parquet_writer(sink, schema) as writer:
+        # collect batches into full row groups, each write_batch call would
+        # otherwise start a new one, and carry the remainder over (slices are
+        # zero-copy)
+        pending: list[pa.RecordBatch] = []
+        pending_rows = 0
+        for batch in chain([first], batches):
+            pending.append(batch)
+            pending_rows += batch.num_rows
+            if pending_rows < PARQUET_ROW_GROUP_SIZE:
+                continue
+
+            table = pa.Table.from_batches(pending, schema=schema)
+            full_rows = pending_rows - pending_rows % PARQUET_ROW_GROUP_SIZE
+            writer.write_table(
+                table.slice(0, full_rows), row_group_size=PARQUET_ROW_GROUP_SIZE
+            )
+            pending = table.slice(full_rows).to_batches()
+            pending_rows -= full_rows
+            if chunk := sink.drain():
+                yield chunk
+
+        if pending_rows:
+            writer.write_table(pa.Table.from_batches(pending, schema=schema))
+
+    # last row group and footer
+    yield sink.drain()
+
+
+def stream_arrow(
+    reader: pa.RecordBatchReader, geom_column: str, bbox_column: str
+) -> Generator[bytes]:
+    """Stream an uncompressed Arrow IPC stream, passing the record batches
+    through without the encoding and compression Parquet requires.
+    """
+    schema = with_geo_metadata(reader.schema, geom_column, bbox_column)
+
+    sink = ChunkSink()
+    with pa.ipc.new_stream(sink, schema) as writer:
         for batch in reader:
             writer.write_batch(batch)
+            if chunk := sink.drain():
+                yield chunk
 
-    buf.seek(0)
-    return buf
+    # schema (if there were no batches) and end-of-stream marker
+    yield sink.drain()
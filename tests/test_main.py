@@ -0,0 +1,411 @@
+import csv
+import io
+import queue
+import threading
+import time
+
+import anyio
+import duckdb
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+from starlette.requests import ClientDisconnect
+
+from app.main import (
+    CURSOR_POOL_SIZE,
+    FEATURE_CSV_SQL,
+    FEATURE_JSON_SQL,
+    ClosingStreamingResponse,
+    app,
+    build_feature_sql,
+    parquet_schema,
+    prefetch_in_thread,
+)
+from app.serializers import stream_csv_arrow, stream_geojsonseq_arrow
+
+
+@pytest.fixture
+def con():
+    con = duckdb.connect()
+    # stand-ins for the spatial functions, `g` holds GeoJSON text
+    con.execute("CREATE MACRO ST_AsGeoJSON(g) AS g")
+    con.execute("CREATE MACRO ST_AsText(g) AS g")
+    con.execute("""CREATE TABLE features AS SELECT * FROM (VALUES
+        (
+            '{"type":"Point","coordinates":[0,0]}',
+            1,
+            'nan'::DOUBLE,
+            TIMESTAMP '2020-01-01 00:00:00',
+            {'xmin': 'inf'::DOUBLE, 'values': [1.5, '-inf'::DOUBLE]},
+            [1.0, 'nan'::DOUBLE]::DOUBLE[2],
+            MAP {'a': 'nan'::DOUBLE},
+            union_value(num := 'inf'::DOUBLE)::UNION(num DOUBLE, "time" TIMESTAMP)
+        ),
+        (
+            '{"type":"Point","coordinates":[1,1]}',
+            2,
+            2.5,
+            TIMESTAMP '2020-01-01 00:00:00.5',
+            NULL,
+            [2.0, '-inf'::DOUBLE]::DOUBLE[2],
+            MAP {'b': 1.5},
+            union_value("time" := TIMESTAMP '2020-01-01 00:00:00')
+                ::UNION(num DOUBLE, "time" TIMESTAMP)
+        ),
+        (NULL, 3, 0.0, NULL, NULL, NULL, NULL, NULL)
+    ) t(g, id, "value", "time", "nested", "fixed", "map", "choice")""")
+    return con
+
+
+def feature_sql(con, query, sql):
+    schema = con.execute(f"SELECT * FROM ({sql}) LIMIT 0").fetch_record_batch().schema
+    return build_feature_sql(query, schema, sql, "g")
+
+
+def fetch_features(con, query, sql):
+    return [
+        orjson.loads(feature)
+        for (feature,) in con.execute(feature_sql(con, query, sql)).fetchall()
+    ]
+
+
+def test_feature_json_sql(con):
+    features = fetch_features(con, FEATURE_JSON_SQL, "SELECT * FROM features")
+
+    # the row without geometry is skipped
+    assert features == [
+        {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [0, 0]},
+            "properties": {
+                "id": 1,
+                "value": None,
+                "time": "2020-01-01T00:00:00",
+                "nested": {"xmin": None, "values": [1.5, None]},
+                "fixed": [1.0, None],
+                "map": {"a": None},
+                "choice": None,
+            },
+        },
+        {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [1, 1]},
+            "properties": {
+                "id": 2,
+                "value": 2.5,
+                "time": "2020-01-01T00:00:00.500000",
+                "nested": None,
+                "fixed": [2.0, None],
+                "map": {"b": 1.5},
+                "choice": "2020-01-01T00:00:00",
+            },
+        },
+    ]
+
+
+def test_feature_json_sql_geometry_only(con):
+    features = fetch_features(con, FEATURE_JSON_SQL, "SELECT g FROM features")
+
+    assert [feature["properties"] for feature in features] == [{}, {}]
+
+
+@pytest.mark.parametrize(
+    "time_zone", ["UTC", "Europe/Berlin", "Asia/Kolkata", "America/St_Johns"]
+)
+def test_feature_json_sql_timestamptz(con, time_zone):
+    con.execute(f"SET TimeZone = '{time_zone}'")
+    sql = """SELECT
+        g,
+        TIMESTAMPTZ '2020-01-01 05:00:00+02' AS winter,
+        TIMESTAMPTZ '2020-07-01 05:00:00.25+02' AS summer
+    FROM features
+    WHERE g IS NOT NULL"""
+
+    features = fetch_features(con, FEATURE_JSON_SQL, sql)
+
+    # the same as orjson renders the Arrow values, in the session time zone
+    expected = (
+        con.execute(f"SELECT * EXCLUDE (g) FROM ({sql})")
+        .fetch_record_batch()
+        .read_all()
+        .to_pylist()
+    )
+    assert [feature["properties"] for feature in features] == orjson.loads(
+        orjson.dumps(expected)
+    )
+
+
+def test_feature_json_sql_geojsonseq(con):
+    sql = 'SELECT g, "value" FROM features'
+    batches = con.execute(feature_sql(con, FEATURE_JSON_SQL, sql)).fetch_record_batch(1)
+
+    content = b"".join(stream_geojsonseq_arrow(batches))
+
+    features = [orjson.loads(line) for line in content.splitlines()]
+    assert content.endswith(b"\n")
+    assert [feature["properties"] for feature in features] == [
+        {"value": None},
+        {"value": 2.5},
+    ]
+
+
+def test_feature_csv_sql(con):
+    sql = 'SELECT g, "value" FROM features'
+    batches = con.execute(feature_sql(con, FEATURE_CSV_SQL, sql)).fetch_record_batch()
+
+    rows = list(
+        csv.DictReader(io.StringIO(b"".join(stream_csv_arrow(batches)).decode()))
+    )
+
+    assert [orjson.loads(row["properties"]) for row in rows] == [
+        {"value": None},
+        {"value": 2.5},
+    ]
+    assert rows[0]["geometry"] == '{"type":"Point","coordinates":[0,0]}'
+
+
+def test_feature_csv_sql_geometry_only(con):
+    batches = con.execute(
+        feature_sql(con, FEATURE_CSV_SQL, "SELECT g FROM features")
+    ).fetch_record_batch()
+
+    rows = list(
+        csv.DictReader(io.StringIO(b"".join(stream_csv_arrow(batches)).decode()))
+    )
+
+    assert [row["properties"] for row in rows] == ["{}", "{}"]
+
+
+def test_prefetch_in_thread_cancelled():
+    closed = threading.Event()
+
+    def chunks():
+        try:
+            yield b"first"
+            # the consumer is cancelled while waiting for a chunk that never comes
+            time.sleep(0.2)
+        finally:
+            closed.set()
+
+    async def consume():
+        stream = prefetch_in_thread(chunks())
+        with anyio.move_on_after(0.05):
+            async for _ in stream:
+                pass
+        await stream.aclose()
+
+    # returns only once no worker thread is left blocked on the buffer
+    anyio.run(consume)
+
+    assert closed.is_set()
+
+
+def test_prefetch_in_thread_bounded():
+    lock = threading.Lock()
+    running = [0]
+    most_running = [0]
+
+    def chunks():
+        with lock:
+            running[0] += 1
+            most_running[0] = max(most_running[0], running[0])
+        try:
+            for _ in range(5):
+                time.sleep(0.005)
+                yield b"chunk"
+        finally:
+            with lock:
+                running[0] -= 1
+
+    async def consume():
+        done = []
+
+        async def read_all():
+            async for _ in prefetch_in_thread(chunks(), max_buffered=1):
+                pass
+            done.append(True)
+
+        # more streams than producers and anyio worker threads together, so
+        # streams waiting for a producer must not hold a worker thread
+        streams = CURSOR_POOL_SIZE + 50
+        with anyio.fail_after(10):
+            async with anyio.create_task_group() as tg:
+                for _ in range(streams):
+                    tg.start_soon(read_all)
+        assert len(done) == streams
+
+    anyio.run(consume)
+
+    # further streams waited for a free producer
+    assert most_running[0] == CURSOR_POOL_SIZE
+
+
+def test_prefetch_in_thread_stalled_consumer(monkeypatch):
+    monkeypatch.setattr("app.main.PREFETCH_PUT_TIMEOUT", 0.05)
+    closed = threading.Event()
+
+    def chunks():
+        try:
+            while True:
+                yield b"chunk"
+        finally:
+            closed.set()
+
+    async def consume():
+        stream = prefetch_in_thread(chunks(), max_buffered=1)
+        await anext(stream)
+        # the client stops reading, and the producer gives up on it
+        assert await anyio.to_thread.run_sync(closed.wait, 5)
+        with pytest.raises(TimeoutError):
+            async for _ in stream:
+                pass
+
+    anyio.run(consume)
+
+
+def test_closing_streaming_response_client_disconnect():
+    closed = []
+
+    async def body():
+        try:
+            yield b"first"
+            yield b"second"
+        finally:
+            closed.append(True)
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            raise OSError
+
+    async def respond():
+        response = ClosingStreamingResponse(body())
+        scope = {"type": "http", "asgi": {"spec_version": "2.4"}}
+        with pytest.raises(ClientDisconnect):
+            await response(scope, receive, send)
+        # closed by the response itself, not when the event loop shuts down
+        assert closed == [True]
+
+    anyio.run(respond)
+
+
+@pytest.fixture
+def cursor_pool(con):
+    # a single pooled cursor, without running the lifespan's extension setup
+    app.state.db = con
+    app.state.cursor_pool = queue.Queue(maxsize=1)
+    app.state.cursor_pool.put_nowait(con.cursor())
+    yield app.state.cursor_pool
+    del app.state.db, app.state.cursor_pool
+
+
+@pytest.mark.parametrize(
+    "path",
+    [
+        # tile out of range
+        "/tiles/1/0/2?url=missing.parquet",
+        # DuckDB fails to open the file
+        "/features/count?url=missing.parquet",
+    ],
+)
+def test_cursor_returned_on_error(cursor_pool, path):
+    cursor = cursor_pool.queue[0]
+
+    response = TestClient(app, raise_server_exceptions=False).get(path)
+
+    assert response.status_code >= 400
+    assert list(cursor_pool.queue) == [cursor]
+
+
+@pytest.fixture
+def features_url(con, tmp_path):
+    url = str(tmp_path / "features.parquet")
+    con.execute(f"COPY features TO '{url}'")
+    return url
+
+
+def test_get_features_geojson(cursor_pool, features_url):
+    response = TestClient(app).get(
+        "/features", params={"url": features_url, "geom_column": "g", "limit": 1}
+    )
+
+    assert response.headers["content-type"] == "application/geo+json"
+    collection = response.json()
+    assert collection["type"] == "FeatureCollection"
+    assert [feature["properties"]["id"] for feature in collection["features"]] == [1]
+    assert collection["numberMatched"] == 3
+    assert collection["numberReturned"] == 1
+    assert collection["limit"] == 1
+    assert collection["offset"] == 0
+    assert [link["rel"] for link in collection["links"]] == ["self", "next"]
+    assert collection["links"][1]["href"].endswith("&offset=1")
+
+
+def test_get_features_geojson_empty_page(cursor_pool, features_url):
+    response = TestClient(app).get(
+        "/features",
+        params={"url": features_url, "geom_column": "g", "filter": "id = 99"},
+    )
+
+    collection = response.json()
+    assert collection["features"] == []
+    assert collection["numberMatched"] == 0
+    assert collection["numberReturned"] == 0
+    assert [link["rel"] for link in collection["links"]] == ["self"]
+
+
+def test_get_features_geojsonseq(cursor_pool, features_url):
+    response = TestClient(app).get(
+        "/features",
+        params={"url": features_url, "geom_column": "g", "f": "geojsonseq"},
+    )
+
+    features = [orjson.loads(line) for line in response.content.splitlines()]
+    assert response.headers["content-type"] == "application/geo+json-seq"
+    # the row without geometry is skipped
+    assert [feature["properties"]["id"] for feature in features] == [1, 2]
+    # the pooled cursor is back once the stream is done
+    assert cursor_pool.qsize() == 1
+
+
+def test_parquet_schema_cached(con, features_url):
+    schema = parquet_schema(con, features_url)
+    assert schema.names == [
+        "g",
+        "id",
+        "value",
+        "time",
+        "nested",
+        "fixed",
+        "map",
+        "choice",
+    ]
+
+    # answered without querying again
+    con.close()
+    assert parquet_schema(con, features_url) is schema
+
+
+def test_parquet_schema_expires(con, features_url, monkeypatch):
+    monkeypatch.setattr("app.main.PARQUET_SCHEMA_TTL", 0)
+    parquet_schema(con, features_url)
+
+    # a column added under the same url shows up once the entry has expired
+    con.execute(f"COPY (SELECT *, 1 AS added FROM features) TO '{features_url}'")
+    assert parquet_schema(con, features_url).names[-1] == "added"
+
+
+def test_get_features_column_removed(cursor_pool, con, features_url):
+    params = {"url": features_url, "geom_column": "g", "f": "geojsonseq"}
+    TestClient(app).get("/features", params=params)
+
+    # the cached schema still lists the removed column, the query is retried
+    # with a fresh one
+    con.execute(f"COPY (SELECT g, id FROM features) TO '{features_url}'")
+    response = TestClient(app).get("/features", params=params)
+
+    assert response.status_code == 200
+    features = [orjson.loads(line) for line in response.content.splitlines()]
+    assert [feature["properties"] for feature in features] == [{"id": 1}, {"id": 2}]
@@ -1,7 +1,8 @@
 import cql2
 import pytest
+from pyproj import Transformer
 
-from app.models import CQL2FilterParams
+from app.models import BBox, CQL2FilterParams, parse_cql2_filter
 
 
 @pytest.mark.parametrize(
@@ -39,3 +40,44 @@ def test_cql2_filter_validate_passes(filter, filter_lang):
 def test_cql2_filter_validation_fails(filter, filter_lang):
     with pytest.raises(cql2.ValidationError):
         CQL2FilterParams(filter=filter, filter_lang=filter_lang)
+
+
+def test_cql2_filter_parse_is_cached():
+    first = CQL2FilterParams(filter="height > 350").cql_filter
+    second = CQL2FilterParams(filter="height > 350").cql_filter
+
+    assert first is second
+    assert parse_cql2_filter.cache_info().hits > 0
+
+
+def test_bbox_to_sql():
+    bbox = BBox.from_str("-1,-2,3,4")
+
+    assert bbox.to_sql().split(" AND ") == [
+        "bbox.xmin <= 3.0",
+        "bbox.ymin <= 4.0",
+        "bbox.xmax >= -1.0",
+        "bbox.ymax >= -2.0",
+    ]
+
+
+@pytest.mark.parametrize("z,x,y", [[0, 0, 0], [1, 1, 0], [12, 1205, 1539]])
+def test_bbox_from_tile(z, x, y):
+    # tile envelope in EPSG:3857, as computed by ST_TileEnvelope
+    size = 2 * 20037508.342789244 / 2**z
+    xmin = -20037508.342789244 + x * size
+    ymax = 20037508.342789244 - y * size
+    to_wgs84 = Transformer.from_crs(3857, 4326, always_xy=True)
+    expected_min = to_wgs84.transform(xmin, ymax - size)
+    expected_max = to_wgs84.transform(xmin + size, ymax)
+
+    bbox = BBox.from_tile(z, x, y)
+
+    assert (bbox.xmin, bbox.ymin) == pytest.approx(expected_min)
+    assert (bbox.xmax, bbox.ymax) == pytest.approx(expected_max)
+
+
+@pytest.mark.parametrize("z,x,y", [[0, 1, 0], [1, 0, 2], [-1, 0, 0], [2, -1, 0]])
+def test_bbox_from_tile_out_of_range(z, x, y):
+    with pytest.raises(ValueError):
+        BBox.from_tile(z, x, y)
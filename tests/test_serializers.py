@@ -1,48 +1,164 @@
+import csv
+import io
+
 import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
 
-from app.serializers import stream_csv, stream_feature_collection, stream_geojsonseq
+from app.serializers import (
+    stream_arrow,
+    stream_csv_arrow,
+    stream_feature_collection_arrow,
+    stream_geojsonseq_arrow,
+    stream_parquet,
+)
 
 
 @pytest.fixture
-def feature_generator():
-    def _feature_generator():
-        for coords in [[0, 0], [0, 0], [0, 0]]:
-            yield {
-                "type": "Feature",
-                "geometry": {
-                    "type": "Point",
-                    "coordinates": coords,
-                },
-                "properties": {},
-            }
+def geo_reader():
+    bbox = {"xmin": 0.0, "ymin": 0.0, "xmax": 1.0, "ymax": 1.0}
+    return pa.table(
+        {
+            "geometry": [str(i).encode() for i in range(10)],
+            "bbox": [bbox] * 10,
+            "i": list(range(10)),
+        }
+    ).to_reader()
 
-    return _feature_generator()
 
+def test_csv_arrow():
+    batches = [
+        pa.record_batch(
+            {
+                "type": ["Feature", "Feature"],
+                "geometry": ["POINT (0 0)", "POINT (1 1)"],
+                "properties": ['{"id":0}', '{"id":1}'],
+            }
+        ),
+        pa.record_batch(
+            {
+                "type": ["Feature"],
+                "geometry": ["POINT (2 2)"],
+                "properties": ['{"id":2}'],
+            }
+        ),
+    ]
+    output = b"".join(stream_csv_arrow(batches))
 
-def test_csv(feature_generator):
-    output = [row for row in stream_csv(feature_generator)]
+    # pyarrow quotes every string field and ends rows in \n
+    assert output.splitlines(keepends=True)[:2] == [
+        b'"type","geometry","properties"\n',
+        b'"Feature","POINT (0 0)","{""id"":0}"\n',
+    ]
+    rows = list(csv.reader(io.StringIO(output.decode())))
+    assert rows[0] == ["type", "geometry", "properties"]
+    assert [orjson.loads(row[2])["id"] for row in rows[1:]] == [0, 1, 2]
 
-    assert output[0] == "type,geometry,properties\r\n"
-    assert all(
-        row == "Feature,\"{'type': 'Point', 'coordinates': [0, 0]}\",{}\r\n"
-        for row in output[1:]
-    )
+
+def test_csv_arrow_empty():
+    assert list(stream_csv_arrow([])) == []
 
 
-def test_stream_featurecollection(feature_generator):
+def test_stream_featurecollection_arrow():
+    features = [
+        orjson.dumps({"type": "Feature", "geometry": None, "properties": {"id": i}})
+        for i in range(5)
+    ]
+    batches = [
+        pa.record_batch({"feature": pa.array(features[:3], pa.string())}),
+        pa.record_batch({"feature": pa.array([], pa.string())}),
+        pa.record_batch({"feature": pa.array(features[3:], pa.string())}),
+    ]
     output = orjson.loads(
-        b"".join(stream_feature_collection(feature_generator, 3, 3, 10, 0, []))
+        b"".join(stream_feature_collection_arrow(batches, 5, 5, 10, 0, []))
     )
 
     assert output["type"] == "FeatureCollection"
-    assert "numberMatched" in output
-    assert "numberReturned" in output
-    assert "limit" in output
-    assert "offset" in output
-    assert "links" in output
+    assert [feat["properties"]["id"] for feat in output["features"]] == list(range(5))
+    assert output["numberReturned"] == 5
+
+
+def test_stream_parquet(geo_reader):
+    output = pq.read_table(
+        io.BytesIO(b"".join(stream_parquet(geo_reader, "geometry", "bbox")))
+    )
+
+    assert output.num_rows == 10
+    geo = orjson.loads(output.schema.metadata[b"geo"])
+    assert geo["primary_column"] == "geometry"
+    assert geo["columns"]["geometry"]["covering"]["bbox"]["xmin"] == ["bbox", "xmin"]
+
+
+def test_stream_parquet_row_groups(monkeypatch):
+    monkeypatch.setattr("app.serializers.PARQUET_ROW_GROUP_SIZE", 4)
+    bbox = {"xmin": 0.0, "ymin": 0.0, "xmax": 1.0, "ymax": 1.0}
+    table = pa.table(
+        {
+            "geometry": [str(i).encode() for i in range(11)],
+            "bbox": [bbox] * 11,
+            "i": list(range(11)),
+        }
+    )
+    # uneven batches: below, across and past several row groups
+    batches = [
+        batch
+        for offset, length in [(0, 3), (3, 2), (5, 5), (10, 1)]
+        for batch in table.slice(offset, length).to_batches()
+    ]
+    reader = pa.RecordBatchReader.from_batches(table.schema, batches)
+
+    output = pq.ParquetFile(
+        io.BytesIO(b"".join(stream_parquet(reader, "geometry", "bbox")))
+    )
+
+    assert [
+        output.metadata.row_group(i).num_rows
+        for i in range(output.metadata.num_row_groups)
+    ] == [4, 4, 3]
+    assert output.read().column("i").to_pylist() == list(range(11))
+
+
+def test_stream_geojsonseq_arrow():
+    features = [
+        orjson.dumps({"type": "Feature", "geometry": None, "properties": {"id": i}})
+        for i in range(3)
+    ]
+    batches = [
+        pa.record_batch({"feature": pa.array(features[:2], pa.string())}),
+        pa.record_batch({"feature": pa.array(features[2:], pa.string())}),
+    ]
+    output = b"".join(stream_geojsonseq_arrow(batches))
+
+    assert output.endswith(b"\n")
+    assert output.splitlines() == features
+
+
+def test_stream_parquet_empty(geo_reader):
+    schema = geo_reader.schema
+
+    def empty_output(bbox_column: str) -> list[bytes]:
+        reader = pa.RecordBatchReader.from_batches(schema, [])
+        return list(stream_parquet(reader, "geometry", bbox_column))
+
+    (output,) = empty_output("bbox")
+    assert empty_output("bbox")[0] is output
+
+    table = pq.read_table(io.BytesIO(output))
+    assert table.num_rows == 0
+    assert table.schema.names == schema.names
+
+    # the bbox column name only differs in the metadata
+    (other,) = empty_output("other")
+    geo = orjson.loads(pq.read_schema(io.BytesIO(other)).metadata[b"geo"])
+    assert geo["columns"]["geometry"]["covering"]["bbox"]["xmin"] == ["other", "xmin"]
+
 
+def test_stream_arrow(geo_reader):
+    output = pa.ipc.open_stream(
+        b"".join(stream_arrow(geo_reader, "geometry", "bbox"))
+    ).read_all()
 
-def test_stream_geojsonseq(feature_generator):
-    output = [feature for feature in stream_geojsonseq(feature_generator)]
-    assert all(orjson.loads(feat)["type"] == "Feature" for feat in output)
+    assert output.num_rows == 10
+    geo = orjson.loads(output.schema.metadata[b"geo"])
+    assert geo["primary_column"] == "geometry"